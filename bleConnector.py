@@ -1,7 +1,8 @@
 import asyncio
 import logging
-from typing import Optional, Dict, Any, Callable, List
-import re
+import random
+import struct
+from typing import Optional, Dict, Callable, Tuple
 
 from bleak import BleakClient, BleakScanner
 from bleak.backends.device import BLEDevice
@@ -12,6 +13,59 @@ UART_SERVICE_UUID = "6E400001-B5A3-F393-E0A9-E50E24DCCA9E"
 UART_RX_CHAR_UUID = "6E400002-B5A3-F393-E0A9-E50E24DCCA9E"  # Write to this characteristic
 UART_TX_CHAR_UUID = "6E400003-B5A3-F393-E0A9-E50E24DCCA9E"  # Notifications come from this characteristic
 
+# Binary sensor frame: version, valid-sensor bitmask, then temperature, humidity and light as float32
+SENSOR_FRAME = struct.Struct('<BBfff')
+SENSOR_FRAME_VERSION = 1
+
+# Bits in the sensor frame's valid-sensor bitmask
+SENSOR_TEMPERATURE = 0x01
+SENSOR_HUMIDITY = 0x02
+SENSOR_LIGHT = 0x04
+SENSOR_FLAGS = SENSOR_TEMPERATURE | SENSOR_HUMIDITY | SENSOR_LIGHT
+
+# Most unprocessed notification bytes kept before the receive buffer is discarded
+MAX_RX_BUFFER = 512
+
+
+def parse_sensor_data(data: str) -> Dict[str, float]:
+    """
+    Parse a "T:<temp>,H:<humidity>,L:<light>,F:<flags>" payload into a dict keyed by field letter.
+    
+    Fields may be omitted. When an "F" field is present only the sensors it lists are
+    returned; messages without one (older firmware) have every field treated as valid.
+    
+    Raises:
+        ValueError: If a field value is not a valid float
+    """
+    values = {}
+    valid = 'THL'
+    for token in data.split(','):
+        key, _, value = token.partition(':')
+        if key == 'F':
+            valid = value
+        elif key in ('T', 'H', 'L'):
+            values[key] = float(value)
+    return {key: value for key, value in values.items() if key in valid}
+
+
+def parse_sensor_frame(frame: bytes) -> Dict[str, float]:
+    """
+    Unpack a binary sensor frame into the same dict parse_sensor_data returns.
+    
+    Readings are rounded to the two decimals the text format carries, since float32
+    can't represent most of them exactly.
+    """
+    _, flags, temperature, humidity, light = SENSOR_FRAME.unpack(frame)
+    values = {}
+    if flags & SENSOR_TEMPERATURE:
+        values['T'] = round(temperature, 2)
+    if flags & SENSOR_HUMIDITY:
+        values['H'] = round(humidity, 2)
+    if flags & SENSOR_LIGHT:
+        values['L'] = round(light, 2)
+    return values
+
+
 class BLEConnector:
     """
     Manages persistent connections to BLE devices and handles UART data.
@@ -22,7 +76,9 @@ class BLEConnector:
                  scan_timeout: float = 5.0,
                  connection_timeout: float = 10.0,
                  reconnect_delay: float = 2.0,
-                 max_reconnect_attempts: int = 5):
+                 max_reconnect_attempts: int = 5,
+                 max_backoff: float = 30.0,
+                 scanning_mode: str = "active"):
         """
         Initialize the BLE connector.
         
@@ -33,6 +89,9 @@ class BLEConnector:
             connection_timeout: Maximum time to wait for a connection (in seconds)
             reconnect_delay: Time to wait between reconnection attempts (in seconds)
             max_reconnect_attempts: Maximum number of reconnection attempts before giving up
+            max_backoff: Upper bound for the randomized reconnection backoff (in seconds)
+            scanning_mode: Bleak scanning mode, "active" (faster discovery, more radio/battery use)
+                or "passive" (lower power, not supported on every backend)
         """
         if not device_name and not device_address:
             raise ValueError("Either device_name or device_address must be provided")
@@ -43,6 +102,8 @@ class BLEConnector:
         self.connection_timeout = connection_timeout
         self.reconnect_delay = reconnect_delay
         self.max_reconnect_attempts = max_reconnect_attempts
+        self.max_backoff = max_backoff
+        self.scanning_mode = scanning_mode
         
         self.device: Optional[BLEDevice] = None
         self.client: Optional[BleakClient] = None
@@ -50,9 +111,19 @@ class BLEConnector:
         self.is_running = False
         self.reconnect_attempts = 0
         
-        self.advertisement_callbacks: List[Callable[[BLEDevice, AdvertisementData], None]] = []
-        self.connection_callbacks: List[Callable[[bool], None]] = []
-        self.data_callbacks: List[Callable[[str], None]] = []
+        # Set when the device disconnects; created in start() so it binds to the running loop
+        self._disconnected_event: Optional[asyncio.Event] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        
+        # Accumulates notification bytes until a full sensor frame or newline-terminated
+        # message arrives (capped at MAX_RX_BUFFER)
+        self._rx_buf = bytearray()
+        
+        # Tuples rather than lists: registration is rare, dispatch happens on every event
+        self.advertisement_callbacks: Tuple[Callable[[BLEDevice, AdvertisementData], None], ...] = ()
+        self.connection_callbacks: Tuple[Callable[[bool], None], ...] = ()
+        self.data_callbacks: Tuple[Callable[[str], None], ...] = ()
+        self.reading_callbacks: Tuple[Callable[[Dict[str, float]], None], ...] = ()
         
         # Set up logging
         self.logger = logging.getLogger("BLEConnector")
@@ -65,15 +136,19 @@ class BLEConnector:
     
     def register_advertisement_callback(self, callback: Callable[[BLEDevice, AdvertisementData], None]):
         """Register a callback function to process advertisement data."""
-        self.advertisement_callbacks.append(callback)
+        self.advertisement_callbacks = self.advertisement_callbacks + (callback,)
     
     def register_connection_callback(self, callback: Callable[[bool], None]):
         """Register a callback function to be notified of connection status changes."""
-        self.connection_callbacks.append(callback)
+        self.connection_callbacks = self.connection_callbacks + (callback,)
     
     def register_data_callback(self, callback: Callable[[str], None]):
         """Register a callback function to process UART data."""
-        self.data_callbacks.append(callback)
+        self.data_callbacks = self.data_callbacks + (callback,)
+    
+    def register_reading_callback(self, callback: Callable[[Dict[str, float]], None]):
+        """Register a callback function to process readings from binary sensor frames."""
+        self.reading_callbacks = self.reading_callbacks + (callback,)
     
     def _notify_connection_status(self, connected: bool):
         """Notify all registered callbacks of connection status change."""
@@ -93,26 +168,46 @@ class BLEConnector:
     
     def _process_uart_data(self, data: str):
         """Process UART data received from the device."""
-        # First, print the data to the console
-        self.logger.info(f"Received data: {data}")
-        
-        # Try to parse temperature and humidity data
-        try:
-            # Look for T:xx.xx,H:xx.xx format
-            match = re.search(r'T:(\d+\.\d+),H:(\d+\.\d+)', data)
-            if match:
-                temp = float(match.group(1))
-                humidity = float(match.group(2))
-                self.logger.info(f"Parsed values - Temperature: {temp}°C, Humidity: {humidity}%")
-        except Exception as e:
-            self.logger.warning(f"Could not parse data: {e}")
+        # First, print the data to the console. Parsing here is only for the log,
+        # so skip it entirely when INFO logging is disabled.
+        if self.logger.isEnabledFor(logging.INFO):
+            self.logger.info("Received data: %s", data)
+            
+            # Try to parse temperature and light data
+            try:
+                values = parse_sensor_data(data)
+                if 'T' in values and 'L' in values:
+                    self.logger.info("Parsed values - Temperature: %s°C, Light: %s%%", values['T'], values['L'])
+            except ValueError as e:
+                self.logger.warning("Could not parse data: %s", e)
         
         # Notify all registered callbacks
         for callback in self.data_callbacks:
             try:
                 callback(data)
             except Exception as e:
-                self.logger.error(f"Error in data callback: {e}")
+                self.logger.error("Error in data callback: %s", e)
+    
+    def _process_sensor_frame(self, frame: bytes):
+        """Process a binary sensor frame received from the device."""
+        try:
+            values = parse_sensor_frame(frame)
+        except struct.error as e:
+            self.logger.warning("Could not unpack sensor frame: %s", e)
+            return
+        
+        self.logger.info("Received frame: %s", values)
+        
+        # Notify all registered callbacks
+        for callback in self.reading_callbacks:
+            try:
+                callback(values)
+            except Exception as e:
+                self.logger.error("Error in reading callback: %s", e)
+    
+    def _backoff_delay(self) -> float:
+        """Full-jitter exponential backoff, so several hubs don't retry in lockstep."""
+        return random.uniform(0, min(self.max_backoff, self.reconnect_delay * (2 ** self.reconnect_attempts)))
     
     async def _find_device(self) -> Optional[BLEDevice]:
         """Scan for and find the target BLE device."""
@@ -120,31 +215,81 @@ class BLEConnector:
         
         if self.device_address:
             device = await BleakScanner.find_device_by_address(
-                self.device_address, timeout=self.scan_timeout
+                self.device_address, timeout=self.scan_timeout, scanning_mode=self.scanning_mode
             )
             if device:
                 return device
         
-        # If address not provided or device not found by address, scan by name
+        # If address not provided or device not found by address, scan by name.
+        # Stop at the first matching advertisement rather than waiting out the full scan.
         if self.device_name:
-            devices = await BleakScanner.discover(timeout=self.scan_timeout)
-            for device in devices:
-                if device.name and self.device_name.lower() in device.name.lower():
-                    self.device_address = device.address
-                    return device
+            found = asyncio.get_running_loop().create_future()
+            
+            def detection_callback(device: BLEDevice, advertisement_data: AdvertisementData):
+                if not found.done() and device.name and self.device_name.lower() in device.name.lower():
+                    found.set_result(device)
+            
+            scanner = BleakScanner(detection_callback=detection_callback, scanning_mode=self.scanning_mode)
+            await scanner.start()
+            try:
+                device = await asyncio.wait_for(found, timeout=self.scan_timeout)
+                self.device_address = device.address
+                return device
+            except asyncio.TimeoutError:
+                pass
+            finally:
+                await scanner.stop()
         
         return None
     
     def _notification_handler(self, sender, data):
         """Handle notifications received from the UART TX characteristic."""
-        try:
-            # Try to decode the data as UTF-8
-            decoded_data = data.decode('utf-8').strip()
-            self._process_uart_data(decoded_data)
-        except Exception as e:
-            self.logger.error(f"Error handling notification: {e}")
-            # If decoding fails, log the raw data
-            self.logger.info(f"Raw data: {data}")
+        # Usual case: exactly one binary sensor frame per notification
+        if not self._rx_buf and len(data) == SENSOR_FRAME.size and data[0] == SENSOR_FRAME_VERSION:
+            self._process_sensor_frame(bytes(data))
+            return
+        
+        # Otherwise frames and text messages may be split across notifications or
+        # merged into one, so consume complete ones from the front of the buffer.
+        # A binary frame starts with the version byte, which can't begin a text
+        # message; anything else is text up to the next newline.
+        buf = self._rx_buf
+        buf.extend(data)
+        while buf:
+            if buf[0] == SENSOR_FRAME_VERSION:
+                if len(buf) >= 2 and buf[1] & ~SENSOR_FLAGS:
+                    # Not a valid frame header; drop a byte and look for the next message
+                    del buf[:1]
+                    continue
+                if len(buf) < SENSOR_FRAME.size:
+                    break
+                frame = bytes(buf[:SENSOR_FRAME.size])
+                del buf[:SENSOR_FRAME.size]
+                self._process_sensor_frame(frame)
+                continue
+            
+            newline = buf.find(b'\n')
+            if newline < 0:
+                break
+            line = bytes(buf[:newline])
+            del buf[:newline + 1]
+            try:
+                # Try to decode the data as UTF-8. Lines normally have no trailing
+                # whitespace left, so only pay for rstrip() when there is some.
+                if line and line[-1] in (0x0d, 0x20):
+                    decoded_data = line.decode('utf-8').rstrip()
+                else:
+                    decoded_data = line.decode('utf-8')
+                self._process_uart_data(decoded_data)
+            except Exception as e:
+                self.logger.error("Error handling notification: %s", e)
+                # If decoding fails, log the raw data
+                self.logger.info("Raw data: %s", line)
+        
+        # Never let an unterminated message grow the buffer without bound
+        if len(buf) > MAX_RX_BUFFER:
+            self.logger.warning("Discarding %d unprocessed bytes", len(buf))
+            buf.clear()
     
     async def _connect_to_device(self) -> bool:
         """Establish connection to the device and set up notification handling."""
@@ -160,7 +305,9 @@ class BLEConnector:
                 self.logger.warning(f"Disconnected from {self.device.name}")
                 self.is_connected = False
                 self._notify_connection_status(False)
-                # No need to manually reconnect here as the main loop will handle it
+                # Wake the main loop, which handles reconnecting. Bleak may invoke
+                # this callback from a backend thread, so hand off to the loop.
+                self._wake_main_loop()
             
             # Create client with disconnection callback
             self.client = BleakClient(
@@ -173,11 +320,11 @@ class BLEConnector:
             await self.client.connect()
             self.is_connected = True
             self.reconnect_attempts = 0
+            self._rx_buf.clear()
             self.logger.info(f"Connected to {self.device.name}")
             
-            # Check for UART service
-            services = await self.client.get_services()
-            if services.get_service(UART_SERVICE_UUID):
+            # Check for UART service (connect() already ran service discovery)
+            if self.client.services.get_service(UART_SERVICE_UUID):
                 self.logger.info("UART Service found")
                 
                 # Set up notification handler for the TX characteristic
@@ -197,6 +344,11 @@ class BLEConnector:
             self.is_connected = False
             return False
     
+    def _wake_main_loop(self):
+        """Wake the main loop from any thread so it re-checks the connection state."""
+        if self._loop and self._disconnected_event:
+            self._loop.call_soon_threadsafe(self._disconnected_event.set)
+    
     async def setup_advertisement_listener(self):
         """Set up a listener for advertisements from the target device."""
         self.logger.info("Setting up advertisement listener")
@@ -207,19 +359,21 @@ class BLEConnector:
                 self._process_advertisement(device, advertisement_data)
         
         # Start the scanner with the callback
-        scanner = BleakScanner()
-        scanner.register_detection_callback(callback)
+        scanner = BleakScanner(detection_callback=callback, scanning_mode=self.scanning_mode)
         await scanner.start()
         return scanner
     
     async def start(self):
         """Start the BLE connector and maintain connection."""
         self.is_running = True
+        self._loop = asyncio.get_running_loop()
+        self._disconnected_event = asyncio.Event()
         
-        # Start advertisement listener
-        scanner = await self.setup_advertisement_listener()
-        
+        scanner = None
         try:
+            # Start advertisement listener
+            scanner = await self.setup_advertisement_listener()
+            
             while self.is_running:
                 # If not connected, try to find and connect to the device
                 if not self.is_connected:
@@ -232,26 +386,30 @@ class BLEConnector:
                             self.reconnect_attempts += 1
                             if self.reconnect_attempts >= self.max_reconnect_attempts:
                                 self.logger.error(f"Failed to connect after {self.max_reconnect_attempts} attempts")
-                                await asyncio.sleep(30)  # Wait longer before trying again
+                                await asyncio.sleep(random.uniform(0, self.max_backoff))  # Wait longer before trying again
                                 self.reconnect_attempts = 0
                                 continue
                             
-                            self.logger.info(f"Retrying connection in {self.reconnect_delay} seconds")
-                            await asyncio.sleep(self.reconnect_delay)
+                            delay = self._backoff_delay()
+                            self.logger.info(f"Retrying connection in {delay:.2f} seconds")
+                            await asyncio.sleep(delay)
                             continue
                     else:
-                        self.logger.warning("Device not found, retrying scan...")
-                        await asyncio.sleep(self.reconnect_delay)
+                        delay = self._backoff_delay()
+                        self.logger.warning(f"Device not found, retrying scan in {delay:.2f} seconds")
+                        await asyncio.sleep(delay)
                         continue
                 
-                # If connected, just keep the connection alive
-                await asyncio.sleep(1)
+                # If connected, sleep until the device disconnects or stop() is called
+                await self._disconnected_event.wait()
+                self._disconnected_event.clear()
                 
         except Exception as e:
             self.logger.error(f"Error in BLE connector: {e}")
         finally:
             # Clean up
-            await scanner.stop()
+            if scanner:
+                await scanner.stop()
             if self.client and self.is_connected:
                 try:
                     await self.client.stop_notify(UART_TX_CHAR_UUID)
@@ -264,6 +422,7 @@ class BLEConnector:
     async def stop(self):
         """Stop the BLE connector."""
         self.is_running = False
+        self._wake_main_loop()
         if self.client and self.is_connected:
             try:
                 await self.client.stop_notify(UART_TX_CHAR_UUID)
@@ -297,23 +456,27 @@ async def main():
     def on_data_received(data):
         print(f"Data received: {data}")
         
-        # Parse the data (assuming format like "T:22.15,H:52.15")
+        # Parse the data (assuming format like "T:22.15,L:41.20,F:TL")
         try:
-            match = re.search(r'T:(\d+\.\d+),H:(\d+\.\d+)', data)
-            if match:
-                temp = float(match.group(1))
-                humidity = float(match.group(2))
-                print(f"Temp: {temp}°C, Humidity: {humidity}%")
+            values = parse_sensor_data(data)
+            if 'T' in values and 'L' in values:
+                print(f"Temp: {values['T']}°C, Light: {values['L']}%")
                 
                 # Here you could do something with the data, like:
                 # - Save to a database
                 # - Update a visualization
                 # - Trigger an action based on thresholds
-        except Exception as e:
+        except ValueError as e:
             print(f"Error parsing data: {e}")
     
-    # Register the callback
+    # Register a callback for readings from binary sensor frames
+    # (already parsed, e.g. {'T': 22.15, 'L': 41.2})
+    def on_reading_received(values):
+        print(f"Readings received: {values}")
+    
+    # Register the callbacks
     connector.register_data_callback(on_data_received)
+    connector.register_reading_callback(on_reading_received)
     
     # Start the connector
     await connector.start()
@@ -6,8 +6,8 @@ Description: This code is for locking and unlocking the device. Once unlocked, i
 """
 
 import time
+import struct
 import board
-import random
 import analogio
 import adafruit_thermistor
 from adafruit_ble import BLERadio
@@ -19,6 +19,13 @@ ble = BLERadio()
 uart = UARTService()
 advertisement = ProvideServicesAdvertisement(uart)
 
+# Binary sensor frame, matching SENSOR_FRAME in the hub's bleConnector.py:
+# version, valid-sensor bitmask, then temperature, humidity and light as float32
+FRAME_FORMAT = "<BBfff"
+FRAME_VERSION = 1
+SENSOR_TEMPERATURE = 0x01
+SENSOR_LIGHT = 0x04
+
 thermistor = adafruit_thermistor.Thermistor(board.TEMPERATURE, 10000, 10000, 25, 3950)
 light_sensor = analogio.AnalogIn(board.LIGHT)
 
@@ -30,23 +37,29 @@ def get_light_percentage():
     percentage = (raw_value / 65535) * 100
     return percentage
 
-# Function to get sensor data
+# Function to get sensor data as a binary frame
 def get_sensor_data():
     try:
         # Read temperature from thermistor (in Celsius)
         temperature = thermistor.temperature
         
-        # Simulate humidity reading (for example purposes)
-        humidity = random.uniform(40.0, 60.0)
-
         # Read light intensity as percentage
         light_intensity = get_light_percentage()
         
-        return f"T:{temperature:.2f},H:{humidity:.2f},L:{light_intensity:.2f}"
+        # The bitmask lists the sensors with real readings. There is no humidity
+        # sensor on this board yet, so its slot is left at 0 and not flagged.
+        return struct.pack(
+            FRAME_FORMAT,
+            FRAME_VERSION,
+            SENSOR_TEMPERATURE | SENSOR_LIGHT,
+            temperature,
+            0.0,
+            light_intensity,
+        )
     except RuntimeError as e:
         # DHT sensors can sometimes fail to read
         print(f"Sensor reading error: {e}")
-        return "Error reading sensors"
+        return b"Error reading sensors\n"
 
 print("Starting BLE UART service")
 
@@ -77,8 +90,8 @@ while True:
         data_to_send = get_sensor_data()
 
         # Send it over UART
-        uart.write(f"{data_to_send}\n".encode("utf-8"))
-        print(f"Sent: {data_to_send}")
+        uart.write(data_to_send)
+        print("Sent:", data_to_send)
 
         # Wait before sending the next update
         time.sleep(5.0)
@@ -0,0 +1,71 @@
+import hashlib
+import time
+import orjson
+from flask import Response, request
+from flask_caching import Cache
+
+# Short-lived in-process cache so bursts of status polls are answered without calling
+# the view. Shared by the device blueprints, each under its own key; devices.py binds it.
+cache = Cache(config={"CACHE_TYPE": "SimpleCache"})
+
+# Offset from the monotonic clock to wall-clock time, measured once at startup
+_EPOCH_OFFSET_NS = time.time_ns() - time.monotonic_ns()
+
+
+def timestamp():
+    """Current time as integer nanoseconds since the epoch, read from the monotonic clock"""
+    return time.monotonic_ns() + _EPOCH_OFFSET_NS
+
+
+def _body_etag(body):
+    """Strong ETag for the exact status bytes served, so any change (last_changed included) gets a new tag"""
+    return hashlib.blake2b(body, digest_size=8).hexdigest()
+
+
+def serialize_status(state, body=None):
+    """Pre-serialize a state for /api/status along with its ETag (body may be passed in if already encoded)"""
+    if body is None:
+        body = orjson.dumps(state)
+    return {"etag": _body_etag(body), "body": body}
+
+
+def empty_response(status, etag):
+    """Empty response (304 or 412) carrying the current ETag"""
+    response = Response(status=status)
+    response.set_etag(etag)
+    return response
+
+
+def precondition_failed(etag):
+    """
+    Check a control request's conditional headers against the current ETag, returning
+    a 412 response if they fail (None if the request may proceed).
+    
+    If-Match lists the tags the client expects (optimistic concurrency). If-None-Match
+    lets a client re-sending a command skip it when the device still has the tag that
+    command produced last time; the hub uses this for its periodic re-sends.
+    """
+    if request.if_match and not request.if_match.contains(etag):
+        return empty_response(412, etag)
+    if request.if_none_match.contains(etag):
+        return empty_response(412, etag)
+    return None
+
+
+def cached_status(key):
+    """Cache a status view under key for a second; conditional requests always reach the view"""
+    return cache.cached(timeout=1, key_prefix=key, unless=lambda: 'If-None-Match' in request.headers)
+
+
+def state_response(cached):
+    """Pre-serialized state with its ETag"""
+    response = Response(cached["body"], mimetype="application/json")
+    response.set_etag(cached["etag"])
+    return response
+
+
+def status_response(cached):
+    """Serve a pre-serialized status, or an empty 304 to pollers that already have this version"""
+    if request.if_none_match.contains(cached["etag"]):
+        return empty_response(304, cached["etag"])
+    return state_response(cached)
\ No newline at end of file
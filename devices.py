@@ -0,0 +1,48 @@
+import os
+import logging
+import orjson
+from flask import Flask
+from flask.json.provider import DefaultJSONProvider
+import smartLight
+import thermostat
+from deviceCommon import cache
+
+# Set up logging
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+
+# Skip the dev server's per-request access log; state changes are still logged
+logging.getLogger('werkzeug').setLevel(logging.WARNING)
+
+
+class OrjsonProvider(DefaultJSONProvider):
+    """JSON provider that encodes and decodes request/response bodies with orjson"""
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj).decode()
+    
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+
+# One process serves both devices: the light under /light, the thermostat under /thermo
+app = Flask(__name__)
+app.json = OrjsonProvider(app)
+
+cache.init_app(app)
+
+app.register_blueprint(smartLight.light_bp)
+app.register_blueprint(thermostat.thermo_bp)
+
+
+if __name__ == "__main__":
+    # Get port from environment or use default
+    port = int(os.environ.get('PORT', 5001))
+    
+    # When deployed (PORT set), replace this process with gunicorn running a gevent worker
+    if 'PORT' in os.environ:
+        os.execvp("gunicorn", ["gunicorn", "-c", "gunicorn_conf.py", "-b", f"0.0.0.0:{port}", "devices:app"])
+    
+    # Otherwise run the Flask development server
+    app.run(host='0.0.0.0', port=port)
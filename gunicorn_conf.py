@@ -0,0 +1,13 @@
+# Gunicorn settings for the device service (smart light and thermostat).
+# The bind address is passed on the command line by devices.py.
+import os
+
+# A single gevent worker multiplexes concurrent requests on greenlets, so
+# module-level device state stays in one process
+worker_class = "gevent"
+workers = 1
+worker_connections = 1000
+
+# No per-request access log unless ACCESS_LOG is set (e.g. ACCESS_LOG=- for stdout
+# while debugging); device state changes are logged by the device modules themselves
+accesslog = os.environ.get('ACCESS_LOG')
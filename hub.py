@@ -1,13 +1,16 @@
 import asyncio
+import concurrent.futures
 import logging
-import json
 import os
-import re
 import requests
+from requests.adapters import HTTPAdapter
 import time
+import threading
 import subprocess
 from flask import Flask, request, jsonify
-from bleConnector import BLEConnector
+from hypercorn.asyncio import serve
+from hypercorn.config import Config
+from bleConnector import BLEConnector, parse_sensor_data
 
 # Set up logging
 logging.basicConfig(
@@ -18,12 +21,33 @@ logger = logging.getLogger("SmartHub")
 
 app = Flask(__name__)
 
+# Cache of the last `minikube ip` result, reused across hub restarts while fresh. Kept in
+# the user's own cache directory, since the hub sends device commands to whatever it holds.
+MINIKUBE_IP_CACHE = os.path.join(os.path.expanduser('~'), '.cache', 'bluefruit-minikube-ip')
+MINIKUBE_IP_CACHE_TTL = 300  # seconds
+
 # Get Minikube IP address
 def get_minikube_ip():
+    try:
+        if time.time() - os.path.getmtime(MINIKUBE_IP_CACHE) < MINIKUBE_IP_CACHE_TTL:
+            with open(MINIKUBE_IP_CACHE) as f:
+                cached_ip = f.read().strip()
+            if cached_ip:
+                return cached_ip
+    except OSError:
+        pass
+    
     try:
         result = subprocess.run(['minikube', 'ip'], capture_output=True, text=True)
         if result.returncode == 0:
-            return result.stdout.strip()
+            ip = result.stdout.strip()
+            try:
+                os.makedirs(os.path.dirname(MINIKUBE_IP_CACHE), exist_ok=True)
+                with open(MINIKUBE_IP_CACHE, 'w') as f:
+                    f.write(ip)
+            except OSError as e:
+                logger.warning(f"Could not cache minikube IP: {e}")
+            return ip
         else:
             logger.error(f"Failed to get minikube IP: {result.stderr}")
             return "localhost"
@@ -31,16 +55,27 @@ def get_minikube_ip():
         logger.error(f"Error getting minikube IP: {e}")
         return "localhost"
 
-MINIKUBE_IP = get_minikube_ip()
-logger.info(f"Using Minikube IP: {MINIKUBE_IP}")
+# Only ask minikube for its IP when a service URL isn't given explicitly
+if os.environ.get('LIGHT_SERVICE_URL') and os.environ.get('THERMOSTAT_SERVICE_URL'):
+    MINIKUBE_IP = None
+else:
+    MINIKUBE_IP = get_minikube_ip()
+    logger.info(f"Using Minikube IP: {MINIKUBE_IP}")
 
 # Use NodePort services in Minikube
-LIGHT_SERVICE_URL = os.environ.get('LIGHT_SERVICE_URL', f'http://{MINIKUBE_IP}:30001')
-THERMOSTAT_SERVICE_URL = os.environ.get('THERMOSTAT_SERVICE_URL', f'http://{MINIKUBE_IP}:30002')
+LIGHT_SERVICE_URL = os.environ.get('LIGHT_SERVICE_URL', f'http://{MINIKUBE_IP}:30001/light')
+THERMOSTAT_SERVICE_URL = os.environ.get('THERMOSTAT_SERVICE_URL', f'http://{MINIKUBE_IP}:30001/thermo')
 
 logger.info(f"Light service URL: {LIGHT_SERVICE_URL}")
 logger.info(f"Thermostat service URL: {THERMOSTAT_SERVICE_URL}")
 
+# Shared HTTP session so calls to the device services reuse pooled keep-alive connections
+SESSION = requests.Session()
+SESSION.mount('http://', HTTPAdapter(pool_connections=4, pool_maxsize=16))
+
+# Timeout (in seconds) for calls to the device services, so a dead service can't block a worker
+REQUEST_TIMEOUT = 2
+
 # Store the latest sensor readings
 latest_readings = {
     "temperature": None,
@@ -53,9 +88,39 @@ latest_readings = {
 settings = {
     "temperature_threshold": 24.0,  # Turn on AC if temperature exceeds this
     "light_threshold": 50.0,        # Turn on lights if below this intensity
+    "temperature_deadband": 0.5,    # Degrees either side of the threshold before the HVAC switches
+    "light_deadband": 5.0,          # Percent either side of the threshold before the light switches
     "auto_mode": True,              # Automatically adjust devices based on sensors
 }
 
+# Device commands are POSTed from worker threads so the BLE loop never blocks on HTTP. Each
+# device has a single worker, so its commands arrive in the order they were queued.
+# Commands beyond MAX_PENDING_COMMANDS in flight are dropped; the next reading re-sends them.
+MAX_PENDING_COMMANDS = 8
+_ctrl_pools = {
+    device: concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"DeviceControl-{device}")
+    for device in ('thermostat', 'light')
+}
+_ctrl_slots = threading.BoundedSemaphore(MAX_PENDING_COMMANDS)
+
+# Makes recording a device's last command and queueing it one step, so callers on the BLE
+# loop and on request threads can't queue in a different order than they recorded
+_ctrl_lock = threading.Lock()
+
+# Re-send an unchanged device command after this many seconds, in case the device restarted
+COMMAND_RECHECK_INTERVAL = 60.0
+
+# Current automation state of each device ('cool'/'off' for hvac, 'on'/'off' for light)
+_last_state = {'hvac': None, 'light': None}
+
+# Last command sent to each device service and when it was sent
+_last_cmd = {'thermostat': None, 'light': None}
+_last_cmd_time = {'thermostat': 0.0, 'light': 0.0}
+
+# ETag each device reported after its last command was applied. Re-sends of that command
+# carry it as If-None-Match, so a device still in that state answers 412 without parsing the body.
+_last_etag = {'thermostat': None, 'light': None}
+
 # BLE connector instance
 ble_connector = None
 
@@ -93,7 +158,7 @@ def control_light():
     """API endpoint to control the smart light"""
     if request.method == 'GET':
         try:
-            response = requests.get(f"{LIGHT_SERVICE_URL}/api/status")
+            response = SESSION.get(f"{LIGHT_SERVICE_URL}/api/status", timeout=REQUEST_TIMEOUT)
             return jsonify(response.json())
         except requests.RequestException as e:
             return jsonify({"error": str(e)}), 500
@@ -101,9 +166,10 @@ def control_light():
     if request.method == 'POST':
         try:
             # Forward the request to the light service
-            response = requests.post(
+            response = SESSION.post(
                 f"{LIGHT_SERVICE_URL}/api/control",
-                json=request.json
+                json=request.json,
+                timeout=REQUEST_TIMEOUT
             )
             return jsonify(response.json())
         except requests.RequestException as e:
@@ -115,7 +181,7 @@ def control_thermostat():
     """API endpoint to control the thermostat"""
     if request.method == 'GET':
         try:
-            response = requests.get(f"{THERMOSTAT_SERVICE_URL}/api/status")
+            response = SESSION.get(f"{THERMOSTAT_SERVICE_URL}/api/status", timeout=REQUEST_TIMEOUT)
             return jsonify(response.json())
         except requests.RequestException as e:
             return jsonify({"error": str(e)}), 500
@@ -123,9 +189,10 @@ def control_thermostat():
     if request.method == 'POST':
         try:
             # Forward the request to the thermostat service
-            response = requests.post(
+            response = SESSION.post(
                 f"{THERMOSTAT_SERVICE_URL}/api/control",
-                json=request.json
+                json=request.json,
+                timeout=REQUEST_TIMEOUT
             )
             return jsonify(response.json())
         except requests.RequestException as e:
@@ -133,78 +200,165 @@ def control_thermostat():
 
 
 def process_ble_data(data_str):
-    """Process data received from BLE UART"""
-    logger.info(f"Processing BLE data: {data_str}")
+    """Process a text message received from BLE UART"""
+    logger.info("Processing BLE data: %s", data_str)
+    
+    try:
+        values = parse_sensor_data(data_str)
+    except ValueError as e:
+        logger.warning("Malformed BLE data: %s (%s)", data_str, e)
+        return
+    
+    process_sensor_readings(values)
+
+
+def process_sensor_readings(values):
+    """Apply sensor readings keyed by field letter ('T', 'H', 'L'), from either a text message or a binary frame"""
+    global latest_readings
     
     try:
-        # Parse temperature data
-        temp_match = re.search(r'T:(\d+\.\d+)', data_str)
-        if temp_match:
-            latest_readings['temperature'] = float(temp_match.group(1))
-            logger.info(f"Temperature updated: {latest_readings['temperature']}°C")
+        # Build the update in a fresh dict and publish it with a single rebind, so
+        # /api/readings never sees a half-updated set of readings
+        readings = dict(latest_readings)
         
-        # Parse humidity data
-        humidity_match = re.search(r'H:(\d+\.\d+)', data_str)
-        if humidity_match:
-            latest_readings['humidity'] = float(humidity_match.group(1))
-            logger.info(f"Humidity updated: {latest_readings['humidity']}%")
-            
-        # Parse light intensity data 
-        light_match = re.search(r'L:(\d+(?:\.\d+)?)', data_str)
-        if light_match:
-            latest_readings['light_intensity'] = float(light_match.group(1))
-            logger.info(f"Light intensity updated: {latest_readings['light_intensity']}%")
+        # Only temperature and light drive automation rules
+        drives_automation = False
+        if 'T' in values:
+            readings['temperature'] = values['T']
+            drives_automation = True
+            logger.info("Temperature updated: %s°C", readings['temperature'])
+        if 'H' in values:
+            readings['humidity'] = values['H']
+            logger.info("Humidity updated: %s%%", readings['humidity'])
+        if 'L' in values:
+            readings['light_intensity'] = values['L']
+            drives_automation = True
+            logger.info("Light intensity updated: %s%%", readings['light_intensity'])
         
         # Update the last reading timestamp
-        latest_readings['last_update'] = time.time()
+        readings['last_update'] = time.time()
+        latest_readings = readings
             
         # Apply automation rules if enabled
-        if settings['auto_mode']:
+        if settings['auto_mode'] and drives_automation:
             apply_automation_rules()
     
     except Exception as e:
-        logger.error(f"Error processing BLE data: {e}")
+        logger.error("Error processing BLE data: %s", e)
+
+
+def _post_device_command(device, url, command, etag):
+    """POST a control command to a device service (runs on the device's control worker)"""
+    try:
+        headers = {'If-None-Match': etag} if etag else None
+        response = SESSION.post(url, json=command, headers=headers, timeout=REQUEST_TIMEOUT)
+        if etag and response.status_code == 412:
+            # The device is still in the state this command produced last time
+            return
+        response.raise_for_status()
+        _last_etag[device] = response.headers.get('ETag')
+    except requests.RequestException as e:
+        # Covers error statuses too (e.g. a 503 while the device pod rolls out)
+        logger.error("Error sending command to %s: %s", device, e)
+        # Forget the command so the next reading retries it
+        if _last_cmd[device] == command:
+            _last_cmd[device] = None
+    finally:
+        _ctrl_slots.release()
+
+
+def send_device_command(device, url, command):
+    """Queue a control command for a device service, skipping it if it was just sent"""
+    with _ctrl_lock:
+        now = time.monotonic()
+        if command == _last_cmd[device] and now - _last_cmd_time[device] < COMMAND_RECHECK_INTERVAL:
+            return False
+        
+        if not _ctrl_slots.acquire(blocking=False):
+            logger.warning("Dropping command for %s, too many commands pending", device)
+            return False
+        
+        # Only a re-send of the same command can be skipped by the device
+        etag = _last_etag[device] if command == _last_cmd[device] else None
+        
+        _last_cmd[device] = command
+        _last_cmd_time[device] = now
+        _ctrl_pools[device].submit(_post_device_command, device, url, command, etag)
+    return True
+
+
+def next_state(current, value, threshold, deadband, above_state, below_state):
+    """Pick a device state for a reading, only switching once it clears the deadband around the threshold"""
+    if current is None:
+        return above_state if value > threshold else below_state
+    if value > threshold + deadband:
+        return above_state
+    if value < threshold - deadband:
+        return below_state
+    return current
 
 
 def apply_automation_rules():
     """Apply automation rules based on sensor readings and thresholds"""
+    # Work from one snapshot of the readings
+    readings = latest_readings
+    
     try:
         # Temperature automation
-        if latest_readings['temperature'] is not None:
-            if latest_readings['temperature'] > settings['temperature_threshold']:
+        if readings['temperature'] is not None:
+            _last_state['hvac'] = next_state(
+                _last_state['hvac'],
+                readings['temperature'],
+                settings['temperature_threshold'],
+                settings['temperature_deadband'],
+                'cool', 'off'
+            )
+            if _last_state['hvac'] == 'cool':
                 # It's too hot, turn on cooling
-                requests.post(
+                target = settings['temperature_threshold'] - 1
+                if send_device_command(
+                    'thermostat',
                     f"{THERMOSTAT_SERVICE_URL}/api/control",
-                    json={"mode": "cool", "target_temperature": settings['temperature_threshold'] - 1}
-                )
-                logger.info(f"Activating cooling to {settings['temperature_threshold'] - 1}°C")
+                    {"mode": "cool", "target_temperature": target}
+                ):
+                    logger.info("Activating cooling to %s°C", target)
             else:
                 # Temperature is comfortable, turn off HVAC
-                requests.post(
+                if send_device_command(
+                    'thermostat',
                     f"{THERMOSTAT_SERVICE_URL}/api/control",
-                    json={"mode": "off"}
-                )
-                logger.info("Deactivating HVAC, temperature is comfortable")
+                    {"mode": "off"}
+                ):
+                    logger.info("Deactivating HVAC, temperature is comfortable")
         
         # Light automation
-        if latest_readings['light_intensity'] is not None:
-            if latest_readings['light_intensity'] < settings['light_threshold']:
+        if readings['light_intensity'] is not None:
+            _last_state['light'] = next_state(
+                _last_state['light'],
+                readings['light_intensity'],
+                settings['light_threshold'],
+                settings['light_deadband'],
+                'off', 'on'
+            )
+            if _last_state['light'] == 'on':
                 # It's dark, turn on light
-                requests.post(
+                if send_device_command(
+                    'light',
                     f"{LIGHT_SERVICE_URL}/api/control",
-                    json={"state": "on", "brightness": 80}
-                )
-                logger.info("Turning lights on, low light intensity detected")
+                    {"state": "on", "brightness": 80}
+                ):
+                    logger.info("Turning lights on, low light intensity detected")
             else:
                 # It's bright, turn off light
-                requests.post(
+                if send_device_command(
+                    'light',
                     f"{LIGHT_SERVICE_URL}/api/control",
-                    json={"state": "off"}
-                )
-                logger.info("Turning lights off, sufficient ambient light")
+                    {"state": "off"}
+                ):
+                    logger.info("Turning lights off, sufficient ambient light")
     
     except Exception as e:
-        logger.error(f"Error applying automation rules: {e}")
+        logger.error("Error applying automation rules: %s", e)
 
 
 async def setup_ble_connector():
@@ -215,10 +369,14 @@ async def setup_ble_connector():
     logger.info(f"Setting up BLE connection to device: {device_name}")
     
     # Create BLE connector instance
-    ble_connector = BLEConnector(device_name=device_name)
+    ble_connector = BLEConnector(
+        device_name=device_name,
+        scanning_mode=os.environ.get('BLE_SCANNING_MODE', 'active')
+    )
     
-    # Register callback for data
+    # Register callbacks for text messages and binary sensor frames
     ble_connector.register_data_callback(process_ble_data)
+    ble_connector.register_reading_callback(process_sensor_readings)
     
     # Register connection status callback
     def on_connection_status(connected):
@@ -234,31 +392,42 @@ async def setup_ble_connector():
     await ble_connector.start()
 
 
-def start_ble_connector_thread():
-    """Start BLE connector in a separate thread"""
-    import threading
-    
-    def run_ble_connector():
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
-        loop.run_until_complete(setup_ble_connector())
-    
-    thread = threading.Thread(target=run_ble_connector)
-    thread.daemon = True
-    thread.start()
-    logger.info("BLE connector thread started")
+def _on_ble_task_done(task):
+    """Report the BLE connector task ending, which leaves the hub without sensor readings"""
+    if task.cancelled():
+        return
+    exc = task.exception()
+    if exc:
+        logger.error("BLE connector task failed", exc_info=exc)
+    else:
+        logger.error("BLE connector stopped; no further sensor readings will arrive")
 
 
-if __name__ == "__main__":
-    import time
-    
-    # Start BLE connector thread immediately
-    logger.info("Starting BLE connector thread")
-    start_ble_connector_thread()
-    
+async def main():
+    """Run the BLE connector and the HTTP API together on one event loop"""
     # Get port from environment or use default
     port = int(os.environ.get('PORT', 5000))
     
-    # Run the Flask app
-    logger.info(f"Starting Flask app on port {port}")
-    app.run(host='0.0.0.0', port=port)
\ No newline at end of file
+    config = Config()
+    config.bind = [f"0.0.0.0:{port}"]
+    
+    # Start the BLE connector as a background task on this loop
+    logger.info("Starting BLE connector task")
+    ble_task = asyncio.create_task(setup_ble_connector())
+    ble_task.add_done_callback(_on_ble_task_done)
+    
+    try:
+        # Serve the Flask app with hypercorn's WSGI mode, which runs each request
+        # on the loop's thread pool so a slow device call doesn't block the others
+        logger.info(f"Starting Flask app on port {port}")
+        await serve(app, config, mode="wsgi")
+    finally:
+        # Shutting down, so the connector ending is expected from here on
+        ble_task.remove_done_callback(_on_ble_task_done)
+        if ble_connector:
+            await ble_connector.stop()
+        ble_task.cancel()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
\ No newline at end of file
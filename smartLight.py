@@ -1,93 +1,151 @@
-import os
 import logging
-import time
-from flask import Flask, request, jsonify
-
-# Set up logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
-)
+import threading
+from dataclasses import dataclass, replace
+from typing import Optional
+from flask import Blueprint, request
+from deviceCommon import (cache, cached_status, precondition_failed, serialize_status, state_response,
+                          status_response, timestamp)
+
 logger = logging.getLogger("SmartLight")
 
-app = Flask(__name__)
+# Routes for the smart light, mounted under /light by devices.py
+light_bp = Blueprint('light', __name__, url_prefix='/light')
+
+# Key for this device's entry in the shared status cache
+STATUS_CACHE_KEY = "light_status"
+
+# Accepted values for the light's on/off state
+_LIGHT_STATES = frozenset(("on", "off"))
+
+# Brightness clamped to 0-100 for integer requests from -1 to 255, indexed by value + 1
+_BRIGHT_LUT = [max(0, min(100, i)) for i in range(-1, 256)]
+
+# Pre-encoded bodies for the states a toggle can produce, same field order as LightState.
+# Only brightness (when turning on) and last_changed vary.
+_TOGGLED_ON_TEMPLATE = b'{"state":"on","brightness":%d,"last_changed":%d}'
+_TOGGLED_OFF_TEMPLATE = b'{"state":"off","brightness":0,"last_changed":%d}'
+
+
+@dataclass
+class LightState:
+    """Light state. Treated as immutable: updates build a new instance with dataclasses.replace"""
+    __slots__ = ("state", "brightness", "last_changed")
+    state: str                    # "on" or "off"
+    brightness: int               # 0-100
+    last_changed: Optional[int]   # Time of last state change, integer ns since the epoch
+
+
+light_state = LightState(state="off", brightness=0, last_changed=None)
 
-# Light state
-light_state = {
-    "state": "off",        # "on" or "off"
-    "brightness": 0,       # 0-100
-    "last_changed": None   # Timestamp of last state change
-}
+# Serializes read-modify-write updates. Updates build a new LightState and swap it in,
+# so readers can use light_state without taking the lock.
+state_lock = threading.Lock()
 
 
-@app.route('/api/status', methods=['GET'])
+# Serialized light_state served by /api/status, rebuilt only when the state changes
+_status_cache = serialize_status(light_state)
+
+
+@light_bp.route('/api/status', methods=['GET'])
+@cached_status(STATUS_CACHE_KEY)
 def get_status():
     """Get the current status of the light"""
-    return jsonify(light_state)
+    return status_response(_status_cache)
 
 
-@app.route('/api/control', methods=['POST'])
+@light_bp.route('/api/control', methods=['POST'])
 def control_light():
     """Control the light"""
-    global light_state
-    
-    # Get the request data
-    data = request.json
-    changed = False
+    global light_state, _status_cache
     
-    # Update state if provided
-    if 'state' in data:
-        state = data['state'].lower()
-        if state in ['on', 'off'] and state != light_state['state']:
-            light_state['state'] = state
-            changed = True
-            logger.info(f"Light turned {state}")
+    # Conditional requests are decided before the body is read, so a re-sent command
+    # the device already applied costs no JSON parsing
+    failed = precondition_failed(_status_cache["etag"])
+    if failed:
+        return failed
     
-    # Update brightness if provided and light is on
-    if 'brightness' in data and light_state['state'] == 'on':
-        brightness = int(max(0, min(100, data['brightness'])))  # 0-100
-        if brightness != light_state['brightness']:
-            light_state['brightness'] = brightness
-            changed = True
-            logger.info(f"Brightness set to {brightness}%")
+    # Get the request data (a missing or malformed body, or JSON that isn't an
+    # object, counts as no changes)
+    data = request.get_json(silent=True, cache=True)
+    if not isinstance(data, dict):
+        data = {}
     
-    # Update timestamp if any changes were made
-    if changed:
-        light_state['last_changed'] = time.time()
+    with state_lock:
+        # Check again against the state the update is applied to, in case another
+        # request changed it while this body was being parsed
+        failed = precondition_failed(_status_cache["etag"])
+        if failed:
+            return failed
+        
+        changes = {}
+        
+        # Update state if provided
+        state = data.get('state')
+        if state is not None:
+            state = state.lower()
+            if state in _LIGHT_STATES and state != light_state.state:
+                changes['state'] = state
+                logger.info(f"Light turned {state}")
+        
+        # Update brightness if provided and light is on
+        brightness = data.get('brightness')
+        if brightness is not None and changes.get('state', light_state.state) == 'on':
+            # 0-100; common integer values come straight from the table
+            if type(brightness) is int and -1 <= brightness <= 255:
+                brightness = _BRIGHT_LUT[brightness + 1]
+            else:
+                brightness = int(max(0, min(100, brightness)))
+            if brightness != light_state.brightness:
+                changes['brightness'] = brightness
+                logger.info(f"Brightness set to {brightness}%")
+        
+        # Update timestamp and publish the new state if any changes were made
+        if changes:
+            new_state = replace(light_state, last_changed=timestamp(), **changes)
+            light_state = new_state
+            _status_cache = serialize_status(new_state)
+            cache.delete(STATUS_CACHE_KEY)
+        
+        cached = _status_cache
     
     # Return the current state
-    return jsonify(light_state)
+    return state_response(cached)
 
 
-@app.route('/api/toggle', methods=['POST'])
+@light_bp.route('/api/toggle', methods=['POST'])
 def toggle_light():
     """Toggle the light on/off"""
-    global light_state
-    
-    # Toggle the state
-    new_state = "off" if light_state['state'] == 'on' else "on"
-    light_state['state'] = new_state
-    
-    # If turning on, set brightness to last value or default to 100
-    if new_state == 'on' and light_state['brightness'] == 0:
-        light_state['brightness'] = 100
+    global light_state, _status_cache
     
-    # If turning off, set brightness to 0
-    if new_state == 'off':
-        light_state['brightness'] = 0
+    with state_lock:
+        # Toggle the state
+        toggled = "off" if light_state.state == 'on' else "on"
+        
+        # If turning on, set brightness to last value or default to 100
+        brightness = light_state.brightness
+        if toggled == 'on' and brightness == 0:
+            brightness = 100
+        
+        # If turning off, set brightness to 0
+        if toggled == 'off':
+            brightness = 0
+        
+        # Build the new state with a fresh timestamp
+        new_state = LightState(state=toggled, brightness=brightness, last_changed=timestamp())
+        
+        # Fill the timestamp into a pre-encoded body rather than serializing the state
+        if toggled == 'on':
+            body = _TOGGLED_ON_TEMPLATE % (new_state.brightness, new_state.last_changed)
+        else:
+            body = _TOGGLED_OFF_TEMPLATE % new_state.last_changed
+        
+        # Publish the new state
+        light_state = new_state
+        _status_cache = serialize_status(new_state, body)
+        cache.delete(STATUS_CACHE_KEY)
+        cached = _status_cache
     
-    # Update timestamp
-    light_state['last_changed'] = time.time()
-    
-    logger.info(f"Light toggled to {new_state}")
+    logger.info(f"Light toggled to {toggled}")
     
     # Return the current state
-    return jsonify(light_state)
-
-
-if __name__ == "__main__":
-    # Get port from environment or use default
-    port = int(os.environ.get('PORT', 5001))
-    
-    # Run the Flask app
-    app.run(host='0.0.0.0', port=port)
\ No newline at end of file
+    return state_response(cached)
@@ -1,51 +1,153 @@
 #!/usr/bin/env python
+import hashlib
 import os
 import subprocess
-import time
+from concurrent.futures import ThreadPoolExecutor
+import re
+import runpy
 import sys
+import time
+
+# Marker file touched whenever Minikube was seen running, so quick restarts can
+# skip `minikube status`
+MINIKUBE_STATUS_CACHE = os.path.join(os.path.expanduser('~'), '.cache', 'bluefruit-minikube-status')
+MINIKUBE_STATUS_TTL = 30  # seconds
+
+# Source hashes of the last successful image builds
+BUILD_CACHE_DIR = '.build-cache'
+
+# Service images: (image name, Dockerfile, files the image is built from)
+SERVICE_IMAGES = [
+    ('smart-devices', 'Dockerfile.devices',
+     ['devices.py', 'deviceCommon.py', 'smartLight.py', 'thermostat.py', 'gunicorn_conf.py', 'requirements.txt']),
+]
+
+# Run a command to completion, discarding its output. stderr is kept and printed
+# only if the command fails. Docker builds use BuildKit.
+def run(cmd, **kwargs):
+    kwargs.setdefault('env', {**os.environ, 'DOCKER_BUILDKIT': '1'})
+    try:
+        return subprocess.run(cmd, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                              text=True, **kwargs)
+    except subprocess.CalledProcessError as e:
+        print(f"Command failed: {' '.join(cmd)}")
+        print(e.stderr, end='')
+        raise
+
+# Resources from the separate light and thermostat services that smart-devices replaced.
+# smart-light-service holds the NodePort (30001) the combined service now uses.
+LEGACY_RESOURCES = ['deployment/smart-light', 'deployment/thermostat',
+                    'service/smart-light-service', 'service/thermostat-service']
 
 # Check if Minikube is running
 def check_minikube():
     print("Checking if Minikube is running...")
+    try:
+        if time.time() - os.path.getmtime(MINIKUBE_STATUS_CACHE) < MINIKUBE_STATUS_TTL:
+            print("Minikube is running (checked recently)")
+            return True
+    except OSError:
+        pass
+    
     try:
         result = subprocess.run(['minikube', 'status'], capture_output=True, text=True)
         if "Running" not in result.stdout:
             print("Minikube is not running. Starting Minikube...")
-            subprocess.run(['minikube', 'start'], check=True)
+            run(['minikube', 'start'])
         print("Minikube is running")
+        
+        os.makedirs(os.path.dirname(MINIKUBE_STATUS_CACHE), exist_ok=True)
+        with open(MINIKUBE_STATUS_CACHE, 'w'):
+            pass
         return True
     except Exception as e:
         print(f"Error checking Minikube status: {e}")
         return False
 
+# Load Minikube's Docker environment into this process, so the docker commands
+# we run afterwards talk to Minikube's daemon
+def use_minikube_docker_env():
+    env_out = subprocess.run(['minikube', '-p', 'minikube', 'docker-env', '--shell=bash'],
+                             capture_output=True, text=True, check=True).stdout
+    for line in env_out.splitlines():
+        match = re.match(r'export (\w+)="(.*)"', line)
+        if match:
+            os.environ[match.group(1)] = match.group(2)
+
+# Hash an image's Dockerfile and sources, to tell whether it needs rebuilding
+def source_hash(dockerfile, sources):
+    digest = hashlib.sha256()
+    for path in [dockerfile] + sources:
+        with open(path, 'rb') as f:
+            digest.update(f.read())
+    return digest.hexdigest()
+
+# Check whether an image was last built from these sources and still exists
+def image_up_to_date(image, digest):
+    try:
+        with open(os.path.join(BUILD_CACHE_DIR, f'{image}.sha')) as f:
+            if f.read().strip() != digest:
+                return False
+    except OSError:
+        return False
+    
+    result = subprocess.run(['docker', 'image', 'inspect', f'{image}:latest'],
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return result.returncode == 0
+
+# Run independent commands at the same time, raising if any of them fails
+def run_parallel(commands, **kwargs):
+    with ThreadPoolExecutor(max_workers=len(commands)) as executor:
+        futures = [executor.submit(run, cmd, **kwargs) for cmd in commands]
+        return [future.result() for future in futures]
+
 # Deploy services to Minikube
 def deploy_services():
     print("Deploying services to Minikube...")
     try:
         # Point Docker to Minikube's Docker daemon
         print("Configuring Docker to use Minikube's Docker daemon...")
-        if sys.platform == "win32":
-            minikube_docker_env = subprocess.run(['minikube', '-p', 'minikube', 'docker-env', '--shell=powershell'], 
-                                               capture_output=True, text=True).stdout
-            exec_cmd = 'Invoke-Expression ' + minikube_docker_env
-            subprocess.run(['powershell', '-Command', exec_cmd], check=True)
-        else:
-            # For non-Windows platforms
-            subprocess.run('eval $(minikube docker-env)', shell=True, check=True)
+        use_minikube_docker_env()
+        
+        # Build Docker images for services whose sources changed since the last build
+        stale = []
+        for image, dockerfile, sources in SERVICE_IMAGES:
+            digest = source_hash(dockerfile, sources)
+            if image_up_to_date(image, digest):
+                print(f"Image {image}:latest is up to date, skipping build")
+            else:
+                stale.append((image, dockerfile, digest))
+        
+        if stale:
+            print("Building Docker images...")
+            run_parallel([
+                ['docker', 'build', '-t', f'{image}:latest', '-f', dockerfile, '.']
+                for image, dockerfile, _ in stale
+            ])
+            
+            os.makedirs(BUILD_CACHE_DIR, exist_ok=True)
+            for image, _, digest in stale:
+                with open(os.path.join(BUILD_CACHE_DIR, f'{image}.sha'), 'w') as f:
+                    f.write(digest)
         
-        # Build Docker images for services
-        print("Building Docker images...")
-        subprocess.run(['docker', 'build', '-t', 'smart-light:latest', '-f', 'Dockerfile.light', '.'], check=True)
-        subprocess.run(['docker', 'build', '-t', 'thermostat:latest', '-f', 'Dockerfile.thermostat', '.'], check=True)
+        # Remove the old per-device services left by earlier deployments (no-op on a fresh cluster),
+        # since apply doesn't prune them and their NodePort would clash
+        run(['kubectl', 'delete', '--ignore-not-found'] + LEGACY_RESOURCES)
         
         # Deploy to Kubernetes
         print("Applying Kubernetes deployment...")
-        subprocess.run(['kubectl', 'apply', '-f', 'k8s-deployment.yaml'], check=True)
+        run(['kubectl', 'apply', '-f', 'k8s-deployment.yaml'])
         
-        # Wait for pods to be ready
+        # Images keep the :latest tag and are never pulled, so apply alone leaves a running
+        # pod on the old image; restart the rollout when an image was rebuilt
+        if stale:
+            print("Restarting pods to pick up the rebuilt image...")
+            run(['kubectl', 'rollout', 'restart', 'deployment/smart-devices'])
+        
+        # Wait for the rollout to finish; a single watch on the Deployment rather
+        # than polling pods by label
         print("Waiting for pods to be ready...")
-        subprocess.run(['kubectl', 'wait', '--for=condition=Ready', 'pod', '-l', 'app=smart-light', '--timeout=120s'], check=True)
-        subprocess.run(['kubectl', 'wait', '--for=condition=Ready', 'pod', '-l', 'app=thermostat', '--timeout=120s'], check=True)
+        run(['kubectl', 'rollout', 'status', 'deployment/smart-devices', '--timeout=120s'])
         
         print("Services deployed successfully")
         return True
@@ -57,14 +159,20 @@ def deploy_services():
 def run_hub():
     print("Starting local hub...")
     try:
-        os.environ['PYTHONUNBUFFERED'] = '1'  # Ensure output is not buffered
-        subprocess.run(['python', 'hub.py'], check=True)
+        # Run the hub in this interpreter instead of starting a second one. Once serving,
+        # hypercorn handles Ctrl+C/SIGTERM itself and the hub returns normally.
+        runpy.run_path('hub.py', run_name='__main__')
+        print("Hub stopped by user")
     except KeyboardInterrupt:
+        # Ctrl+C during hub startup, before hypercorn installs its signal handlers
         print("Hub stopped by user")
     except Exception as e:
         print(f"Error running hub: {e}")
 
 if __name__ == "__main__":
+    # Flush output line by line, so progress and hub logs show up immediately
+    sys.stdout.reconfigure(line_buffering=True)
+    
     if check_minikube() and deploy_services():
         run_hub()
     else:
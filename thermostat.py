@@ -1,92 +1,123 @@
-import os
 import logging
-import time
-from flask import Flask, request, jsonify
-
-# Set up logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
-)
+import threading
+from dataclasses import dataclass, replace
+from typing import Optional
+from flask import Blueprint, request
+from deviceCommon import (cache, cached_status, precondition_failed, serialize_status, state_response,
+                          status_response, timestamp)
+
 logger = logging.getLogger("Thermostat")
 
-app = Flask(__name__)
+# Routes for the thermostat, mounted under /thermo by devices.py
+thermo_bp = Blueprint('thermo', __name__, url_prefix='/thermo')
+
+# Key for this device's entry in the shared status cache
+STATUS_CACHE_KEY = "thermostat_status"
+
+# Accepted values for the thermostat mode and fan settings
+_MODES = frozenset(("off", "heat", "cool", "auto"))
+_FANS = frozenset(("auto", "on"))
+
+
+def _choice(choices):
+    """Build a validator that lower-cases a setting and rejects values outside choices"""
+    def validate(value):
+        value = value.lower()
+        if value not in choices:
+            raise ValueError(f"Unsupported value: {value}")
+        return value
+    return validate
 
-# Thermostat state
-thermostat_state = {
-    "mode": "off",                  # "off", "heat", "cool", "auto"
-    "current_temperature": 22.0,    # Current temperature in Celsius
-    "target_temperature": 22.0,     # Target temperature in Celsius
-    "fan": "auto",                  # "auto" or "on"
-    "humidity": 50.0,               # Current humidity percentage
-    "last_changed": None            # Timestamp of last state change
+
+# Control fields, each with a validator (raises on bad input, leaving the field
+# unchanged) and the message logged when the field changes
+_VALIDATORS = {
+    "mode": (_choice(_MODES), "Thermostat mode set to %s"),
+    # Limit to reasonable range (10-35°C)
+    "target_temperature": (lambda value: max(10.0, min(35.0, float(value))), "Target temperature set to %s°C"),
+    "fan": (_choice(_FANS), "Fan set to %s"),
+    "current_temperature": (float, "Current temperature set to %s°C"),
 }
 
 
-@app.route('/api/status', methods=['GET'])
+@dataclass
+class ThermostatState:
+    """Thermostat state. Treated as immutable: updates build a new instance with dataclasses.replace"""
+    __slots__ = ("mode", "current_temperature", "target_temperature", "fan", "humidity", "last_changed")
+    mode: str                       # "off", "heat", "cool", "auto"
+    current_temperature: float      # Current temperature in Celsius
+    target_temperature: float       # Target temperature in Celsius
+    fan: str                        # "auto" or "on"
+    humidity: float                 # Current humidity percentage
+    last_changed: Optional[int]     # Time of last state change, integer ns since the epoch
+
+
+thermostat_state = ThermostatState(mode="off", current_temperature=22.0, target_temperature=22.0,
+                                   fan="auto", humidity=50.0, last_changed=None)
+
+# Serializes read-modify-write updates. Updates build a new ThermostatState and swap it in,
+# so readers can use thermostat_state without taking the lock.
+state_lock = threading.Lock()
+
+
+# Serialized thermostat_state served by /api/status, rebuilt only when the state changes
+_status_cache = serialize_status(thermostat_state)
+
+
+@thermo_bp.route('/api/status', methods=['GET'])
+@cached_status(STATUS_CACHE_KEY)
 def get_status():
     """Get the current status of the thermostat"""
-    return jsonify(thermostat_state)
+    return status_response(_status_cache)
 
 
-@app.route('/api/control', methods=['POST'])
+@thermo_bp.route('/api/control', methods=['POST'])
 def control_thermostat():
     """Control the thermostat"""
-    global thermostat_state
-    
-    # Get the request data
-    data = request.json
-    changed = False
-    
-    # Update mode if provided
-    if 'mode' in data:
-        mode = data['mode'].lower()
-        if mode in ['off', 'heat', 'cool', 'auto'] and mode != thermostat_state['mode']:
-            thermostat_state['mode'] = mode
-            changed = True
-            logger.info(f"Thermostat mode set to {mode}")
+    global thermostat_state, _status_cache
     
-    # Update target temperature if provided
-    if 'target_temperature' in data:
-        try:
-            temp = float(data['target_temperature'])
-            # Limit to reasonable range (10-35°C)
-            temp = max(10.0, min(35.0, temp))
-            if temp != thermostat_state['target_temperature']:
-                thermostat_state['target_temperature'] = temp
-                changed = True
-                logger.info(f"Target temperature set to {temp}°C")
-        except (ValueError, TypeError):
-            pass
+    # Conditional requests are decided before the body is read, so a re-sent command
+    # the device already applied costs no JSON parsing
+    failed = precondition_failed(_status_cache["etag"])
+    if failed:
+        return failed
     
-    # Update fan setting if provided
-    if 'fan' in data:
-        fan = data['fan'].lower()
-        if fan in ['auto', 'on'] and fan != thermostat_state['fan']:
-            thermostat_state['fan'] = fan
-            changed = True
-            logger.info(f"Fan set to {fan}")
+    # Get the request data (a missing or malformed body, or JSON that isn't an
+    # object, counts as no changes)
+    data = request.get_json(silent=True, cache=True)
+    if not isinstance(data, dict):
+        data = {}
     
-    if 'current_temperature' in data:
-        try:
-            temp = float(data['current_temperature'])
-            thermostat_state['current_temperature'] = temp
-            changed = True
-            logger.info(f"Current temperature set to {temp}°C")
-        except (ValueError, TypeError):
-            pass
-    
-    # Update timestamp if any changes were made
-    if changed:
-        thermostat_state['last_changed'] = time.time()
+    with state_lock:
+        # Check again against the state the update is applied to, in case another
+        # request changed it while this body was being parsed
+        failed = precondition_failed(_status_cache["etag"])
+        if failed:
+            return failed
+        
+        changes = {}
+        
+        # Apply each provided field that passes validation
+        for key, (validate, message) in _VALIDATORS.items():
+            value = data.get(key)
+            if value is None:
+                continue
+            try:
+                value = validate(value)
+            except (ValueError, TypeError, AttributeError):
+                continue
+            if value != getattr(thermostat_state, key):
+                changes[key] = value
+                logger.info(message, value)
+        
+        # Update timestamp and publish the new state if any changes were made
+        if changes:
+            new_state = replace(thermostat_state, last_changed=timestamp(), **changes)
+            thermostat_state = new_state
+            _status_cache = serialize_status(new_state)
+            cache.delete(STATUS_CACHE_KEY)
+        
+        cached = _status_cache
     
     # Return the current state
-    return jsonify(thermostat_state)
-
-
-if __name__ == "__main__":
-    # Get port from environment or use default
-    port = int(os.environ.get('PORT', 5002))
-    
-    # Run the Flask app
-    app.run(host='0.0.0.0', port=port)
\ No newline at end of file
+    return state_response(cached)